@@ -10,7 +10,7 @@ This script:
 Requirements:
 - OpenAI API key (set in OPENAI_API_KEY environment variable)
 - Firebase service account key (serviceAccountKey.json)
-- Python packages: firebase-admin, openai, requests, pillow
+- Python packages: firebase-admin, openai, httpx, requests, tenacity, orjson, pillow
 
 Usage:
     # Test with first story only
@@ -22,28 +22,133 @@ Usage:
     # Generate for all stories (500 images - expensive!)
     python3 generate_story_images.py --all
     
+    # Same, but through the OpenAI Batch API (results within 24h, half price)
+    python3 generate_story_images.py --all --batch
+    
     # Generate batch of 10 stories starting from index
     python3 generate_story_images.py --start 0 --count 10
 """
 
+import asyncio
+import base64
+import hashlib
 import json
 import os
+import queue
+import re
 import sys
 import time
 import argparse
+import urllib.parse
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
 
 # Third-party imports
 import firebase_admin
 from firebase_admin import credentials, storage
-from openai import OpenAI
+from google.api_core import exceptions as gcloud_exceptions
+import httpx
+import openai
+import orjson
+import requests
+from openai import AsyncOpenAI
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    retry,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 # Configuration
 FIREBASE_STORAGE_BUCKET = "arabicstories-82611.firebasestorage.app"
 SERVICE_ACCOUNT_PATH = "serviceAccountKey.json"
 STORIES_JSON_PATH = "ArabicStories/OfflineBundle/stories.json"
 IMAGES_DIR = "generated_images"
+BATCH_INPUT_PATH = os.path.join(IMAGES_DIR, "batch_input.jsonl")
+BATCH_STATE_PATH = os.path.join(IMAGES_DIR, "batch_state.json")
+CACHE_INDEX_PATH = os.path.join(IMAGES_DIR, "cache_index.json")
+PROGRESS_LOG_PATH = os.path.join(IMAGES_DIR, "progress.jsonl")
+
+# Wrapped around every story's imagePrompt. Its exact text is part of the
+# image cache key, so any change here regenerates every image.
+PROMPT_TEMPLATE = """
+{prompt}
+
+Style: Children's picture book illustration, warm and inviting, soft lighting, 
+detailed but not overwhelming, suitable for young readers, family-friendly atmosphere.
+"""
+# DALL-E 3 request parameters, shared by direct calls and --batch requests
+IMAGE_GENERATION_PARAMS = {
+    "model": "dall-e-3",
+    "size": "1024x1024",  # DALL-E 3 supports 1024x1024, 1792x1024, 1024x1792
+    "quality": "standard",  # standard or hd (hd costs more)
+    "n": 1,
+}
+# DALL-E 3 rejects prompts longer than this
+MAX_PROMPT_LENGTH = 4000
+# Prompts screened per moderation request
+MODERATION_BATCH_SIZE = 32
+
+# Characters dropped from titles when building file names; \w matches exactly
+# what str.isalnum() accepts, plus the underscore
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w \-]')
+
+# Peak image memory is bounded by the two concurrency limits below, not by
+# the number of stories. Image bytes are only in memory while a story is
+# being downloaded or uploaded; the upload queue between them holds paths.
+#   peak_mem ≈ MAX_CONCURRENT_GENERATIONS * DOWNLOAD_CHUNK_SIZE  (streamed downloads)
+#            + UPLOAD_WORKERS * ~4MB                             (decoded image during WebP encode)
+
+# Stories generated at once; keep just under the DALL-E 3 images-per-minute limit
+MAX_CONCURRENT_GENERATIONS = 5
+# DALL-E 3 images-per-minute limit for the account's usage tier
+IMAGES_PER_MINUTE = 5
+# Firebase uploads run in a thread pool so they overlap with generation
+UPLOAD_WORKERS = 16
+# Finished images waiting for an uploader; generators block when it is full
+UPLOAD_QUEUE_SIZE = 64
+# Covers are uploaded as WebP, which is far smaller than DALL-E's PNGs
+WEBP_QUALITY = 90
+# Cover names are not content-addressed and a regenerated cover replaces
+# the old blob, so clients only cache covers for a day
+COVER_CACHE_CONTROL = "public, max-age=86400"
+# Keep-alive connections shared by all image downloads
+HTTP_POOL_SIZE = 32
+# Download chunk size; only this much of each image is held in memory at once
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Seconds between status checks of a submitted Batch API job
+BATCH_POLL_INTERVAL = 60
+
+
+class RateLimiter:
+    """Token bucket that paces requests to a per-minute limit."""
+    
+    def __init__(self, max_per_minute):
+        self.max_capacity = max_per_minute
+        self.available_capacity = max_per_minute
+        self.last_update_time = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Take one unit of capacity, waiting only while the bucket is empty."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                refill = (now - self.last_update_time) * self.max_capacity / 60
+                self.available_capacity = min(self.max_capacity, self.available_capacity + refill)
+                self.last_update_time = now
+                
+                if self.available_capacity >= 1:
+                    self.available_capacity -= 1
+                    return
+                
+                await asyncio.sleep((1 - self.available_capacity) * 60 / self.max_capacity)
 
 
 def initialize_firebase():
@@ -52,7 +157,11 @@ def initialize_firebase():
     firebase_admin.initialize_app(cred, {
         'storageBucket': FIREBASE_STORAGE_BUCKET
     })
-    return storage.bucket()
+    bucket = storage.bucket()
+    # All uploader threads share the bucket's session, whose default adapter
+    # keeps only 10 connections per host; give each thread its own
+    bucket.client._http.mount("https://", HTTPAdapter(pool_maxsize=UPLOAD_WORKERS))
+    return bucket
 
 
 def initialize_openai():
@@ -63,40 +172,176 @@ def initialize_openai():
         print("   Get your API key from: https://platform.openai.com/api-keys")
         print("   Then run: export OPENAI_API_KEY='your-key-here'")
         sys.exit(1)
-    return OpenAI(api_key=api_key)
+    return AsyncOpenAI(api_key=api_key)
 
 
-def generate_image(openai_client, prompt, story_title, output_path):
-    """Generate image using DALL-E 3."""
-    # Enhance the prompt for better children's book illustration quality
-    enhanced_prompt = f"""
-{prompt}
+# Transient failures worth retrying. Anything else (e.g. openai.BadRequestError
+# for a content-policy rejection) fails the story immediately.
+RETRYABLE_OPENAI_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+RETRYABLE_FIREBASE_ERRORS = (
+    gcloud_exceptions.TooManyRequests,
+    gcloud_exceptions.ServerError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
 
-Style: Children's picture book illustration, warm and inviting, soft lighting, 
-detailed but not overwhelming, suitable for young readers, family-friendly atmosphere.
-"""
+
+def is_retryable_download_error(error):
+    """Connection problems and 5xx responses from the image host are transient."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def log_retry(retry_state):
+    """Tell the operator a call is being retried."""
+    print(f"   🔁 {retry_state.fn.__name__} failed (attempt {retry_state.attempt_number}): "
+          f"{retry_state.outcome.exception()} - retrying in {retry_state.next_action.sleep:.0f}s")
+
+
+def with_backoff(retry_condition):
+    """Retry a call with random exponential backoff while retry_condition matches."""
+    return retry(
+        wait=wait_random_exponential(min=2, max=60),
+        stop=stop_after_attempt(6),
+        retry=retry_condition,
+        before_sleep=log_retry,
+        reraise=True,
+    )
+
+
+def create_http_client():
+    """Create the HTTP client shared by all image downloads."""
+    # A single pooled client reuses keep-alive connections to the image host
+    # instead of paying a TCP+TLS handshake per download
+    transport = httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=60)
+
+
+def build_prompt(prompt):
+    """Enhance the prompt for better children's book illustration quality."""
+    # Truncate the story's prompt, never the style instructions, to fit the limit
+    max_story_length = MAX_PROMPT_LENGTH - len(PROMPT_TEMPLATE.format(prompt=''))
+    return PROMPT_TEMPLATE.format(prompt=prompt[:max_story_length])
+
+
+async def moderate_prompts(openai_client, stories, indices):
+    """
+    Screen the stories' prompts with the (free) moderation endpoint and return
+    the indices whose prompt is flagged, so they fail before a paid request.
+    """
+    flagged = set()
+    prompted = [i for i in indices if stories[i].get('imagePrompt')]
+    
+    for start in range(0, len(prompted), MODERATION_BATCH_SIZE):
+        chunk = prompted[start:start + MODERATION_BATCH_SIZE]
+        try:
+            response = await openai_client.moderations.create(
+                input=[stories[i]['imagePrompt'] for i in chunk]
+            )
+        except Exception as e:
+            # Moderation is only a preflight check; let DALL-E decide instead
+            print(f"   ⚠️  Moderation check failed, continuing without it: {e}")
+            return flagged
+        
+        for story_index, result in zip(chunk, response.results):
+            if result.flagged:
+                categories = [name for name, hit in result.categories.model_dump().items() if hit]
+                print(f"⚠️  Story {story_index}: Prompt flagged by moderation ({', '.join(categories)}), skipping")
+                flagged.add(story_index)
+    
+    return flagged
+
+
+def prompt_cache_key(prompt):
+    """Cache key for an image: the SHA-256 of the exact prompt sent to DALL-E."""
+    return hashlib.sha256(build_prompt(prompt).encode('utf-8')).hexdigest()
+
+
+def load_cache_index():
+    """Load the prompt-hash -> {"local": path, "url": url} image cache."""
+    if not os.path.exists(CACHE_INDEX_PATH):
+        return {}
+    with open(CACHE_INDEX_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_cache_index(cache):
+    """Save the image cache."""
+    with open(CACHE_INDEX_PATH, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=2)
+
+
+def cached_image(cache, key):
+    """Return the local path of a previously generated image for key, if it still exists."""
+    entry = cache.get(key)
+    if entry and os.path.exists(entry['local']):
+        return entry['local']
+    return None
+
+
+def story_filename(story, story_index):
+    """Local (and remote) file name for a story's cover image."""
+    safe_title = UNSAFE_FILENAME_CHARS.sub('', story['title']).rstrip().replace(' ', '_')[:50]
+    return f"story_{story_index:03d}_{safe_title}.png"
+
+
+def remote_path_for(local_filename):
+    """Firebase Storage path of a story's (WebP) cover image."""
+    return f"story_covers/{os.path.splitext(local_filename)[0]}.webp"
+
+
+def optimize_image(png_path):
+    """Re-encode a generated PNG as WebP next to it and return the WebP path."""
+    webp_path = os.path.splitext(png_path)[0] + '.webp'
+    with Image.open(png_path) as image:
+        image.save(webp_path, 'WEBP', quality=WEBP_QUALITY, method=6)
+    return webp_path
+
+
+@with_backoff(retry_if_exception_type(RETRYABLE_OPENAI_ERRORS))
+async def request_image(openai_client, rate_limiter, enhanced_prompt):
+    """Request one image from DALL-E 3."""
+    await rate_limiter.acquire()
+    # Retries are handled by with_backoff, not by the SDK
+    return await openai_client.with_options(max_retries=0).images.generate(
+        prompt=enhanced_prompt,
+        **IMAGE_GENERATION_PARAMS,
+    )
+
+
+@with_backoff(retry_if_exception(is_retryable_download_error))
+async def download_image(http_client, image_url, output_path):
+    """Download an image, streaming it straight to disk."""
+    # Write to a temporary name first so an interrupted download is never
+    # mistaken for a finished image on the next run
+    partial_path = output_path + '.part'
+    async with http_client.stream('GET', image_url) as img_response:
+        img_response.raise_for_status()
+        with open(partial_path, 'wb') as f:
+            async for chunk in img_response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(partial_path, output_path)
+
+
+async def generate_image(openai_client, http_client, rate_limiter, prompt, story_title, output_path):
+    """Generate image using DALL-E 3."""
+    enhanced_prompt = build_prompt(prompt)
     
     print(f"   🎨 Generating image for: {story_title[:40]}...")
     
     try:
-        response = openai_client.images.generate(
-            model="dall-e-3",
-            prompt=enhanced_prompt,
-            size="1024x1024",  # DALL-E 3 supports 1024x1024, 1792x1024, 1024x1792
-            quality="standard",
-            n=1,
-        )
-        
+        response = await request_image(openai_client, rate_limiter, enhanced_prompt)
         image_url = response.data[0].url
-        
-        # Download the image
-        import requests
-        img_response = requests.get(image_url)
-        img_response.raise_for_status()
-        
-        # Save locally
-        with open(output_path, 'wb') as f:
-            f.write(img_response.content)
+        await download_image(http_client, image_url, output_path)
         
         print(f"   ✅ Image saved: {output_path}")
         return output_path
@@ -106,25 +351,94 @@ detailed but not overwhelming, suitable for young readers, family-friendly atmos
         return None
 
 
-def upload_to_firebase(bucket, local_path, remote_path):
+def public_url_for(remote_path, token):
+    """Firebase Storage download URL for a path in the bucket."""
+    # The download token grants read access whatever the Storage rules say,
+    # so no make_public() round-trip is needed after upload
+    quoted_path = urllib.parse.quote(remote_path, safe='')
+    return (f"https://firebasestorage.googleapis.com/v0/b/{FIREBASE_STORAGE_BUCKET}/o/{quoted_path}"
+            f"?alt=media&token={token}")
+
+
+def download_token(blob):
+    """The first Firebase download token stored on a blob, if any."""
+    tokens = (blob.metadata or {}).get('firebaseStorageDownloadTokens')
+    return tokens.split(',')[0] if tokens else None
+
+
+@with_backoff(retry_if_exception_type(RETRYABLE_FIREBASE_ERRORS))
+def list_remote_covers(bucket):
+    """
+    Map every blob under story_covers/ to its (MD5 hash, download token),
+    with one paginated listing.
+    """
+    return {
+        blob.name: (blob.md5_hash, download_token(blob))
+        for blob in bucket.list_blobs(prefix="story_covers/")
+    }
+
+
+def file_md5(path):
+    """Base64 MD5 of a file, in the same form as a blob's md5_hash."""
+    with open(path, 'rb') as f:
+        return base64.b64encode(hashlib.md5(f.read()).digest()).decode('ascii')
+
+
+@with_backoff(retry_if_exception_type(RETRYABLE_FIREBASE_ERRORS))
+def upload_blob(blob, local_path, token):
+    """Upload a WebP file to a Firebase Storage blob with a download token."""
+    blob.cache_control = COVER_CACHE_CONTROL
+    # Sent with the upload itself, so the token costs no extra request
+    blob.metadata = {'firebaseStorageDownloadTokens': token}
+    blob.upload_from_filename(local_path, content_type='image/webp')
+
+
+def upload_to_firebase(bucket, remote_covers, local_path, remote_path):
     """Upload image to Firebase Storage and return public URL."""
     try:
-        blob = bucket.blob(remote_path)
-        blob.upload_from_filename(local_path)
+        webp_path = optimize_image(local_path)
         
-        # Make the blob publicly accessible
-        blob.make_public()
+        # Skip the upload if the bucket already holds exactly this file
+        remote_md5, remote_token = remote_covers.get(remote_path, (None, None))
+        if remote_token and remote_md5 == file_md5(webp_path):
+            public_url = public_url_for(remote_path, remote_token)
+            print(f"   ☁️  Already in Firebase Storage: {public_url}")
+            return public_url
         
-        print(f"   ✅ Uploaded to Firebase: {blob.public_url}")
-        return blob.public_url
+        token = str(uuid.uuid4())
+        blob = bucket.blob(remote_path)
+        upload_blob(blob, webp_path, token)
+        
+        public_url = public_url_for(remote_path, token)
+        print(f"   ✅ Uploaded to Firebase: {public_url}")
+        return public_url
         
     except Exception as e:
         print(f"   ❌ Error uploading to Firebase: {e}")
         return None
 
 
-def process_story(openai_client, bucket, story, story_index, images_dir):
-    """Process a single story: generate image and upload."""
+def upload_worker(bucket, remote_covers, upload_q, results_q):
+    """Upload queued (local_path, remote_path, story_index) items until a None sentinel arrives."""
+    while True:
+        item = upload_q.get()
+        if item is None:
+            return
+        local_path, remote_path, story_index = item
+        results_q.put((story_index, upload_to_firebase(bucket, remote_covers, local_path, remote_path)))
+
+
+async def enqueue_upload(upload_q, local_path, remote_path, story_index):
+    """Queue an image for upload without blocking the event loop while the queue is full."""
+    await asyncio.to_thread(upload_q.put, (local_path, remote_path, story_index))
+
+
+async def process_story(openai_client, http_client, rate_limiter, cache, have_local, story, story_index, images_dir):
+    """
+    Process a single story: generate its image if needed and return
+    (local_path, remote_path, generated) to upload, where generated tells
+    whether a DALL-E image was paid for.
+    """
     story_id = story['id']
     title = story['title']
     prompt = story.get('imagePrompt', '')
@@ -133,52 +447,346 @@ def process_story(openai_client, bucket, story, story_index, images_dir):
         print(f"⚠️  Story {story_index}: No image prompt found for '{title}'")
         return None
     
-    # Check if already has a cover image URL
-    existing_url = story.get('coverImageURL', '')
-    if existing_url and 'firebasestorage' in existing_url:
-        print(f"⏭️  Story {story_index}: Already has Firebase image, skipping '{title[:40]}...'")
-        return existing_url
-    
     print(f"\n📖 Story {story_index}: {title}")
     
     # Generate local filename
-    safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).rstrip()
-    safe_title = safe_title.replace(' ', '_')[:50]
-    local_filename = f"story_{story_index:03d}_{safe_title}.png"
+    local_filename = story_filename(story, story_index)
     local_path = os.path.join(images_dir, local_filename)
+    cache_key = prompt_cache_key(prompt)
+    cached_path = cached_image(cache, cache_key)
     
-    # Skip if already downloaded
-    if os.path.exists(local_path):
+    # Skip if this exact prompt was already generated, or already downloaded
+    generated = False
+    if cached_path:
+        print(f"   ♻️  Reusing cached image: {cached_path}")
+        local_path = cached_path
+    elif local_filename in have_local:
         print(f"   📁 Image already exists locally")
     else:
         # Generate image
-        result = generate_image(openai_client, prompt, title, local_path)
+        result = await generate_image(openai_client, http_client, rate_limiter, prompt, title, local_path)
         if not result:
             return None
-        
-        # Rate limiting - be nice to OpenAI API
-        time.sleep(1)
+        cache[cache_key] = {"local": local_path, "url": None}
+        generated = True
     
-    # Upload to Firebase
-    remote_path = f"story_covers/{local_filename}"
-    public_url = upload_to_firebase(bucket, local_path, remote_path)
-    
-    return public_url
+    remote_path = remote_path_for(local_filename)
+    return local_path, remote_path, generated
 
 
-def update_stories_json(stories_data, story_index, image_url):
+def update_stories_json(stories_data, story_index, image_url, updated_at=None):
     """Update stories.json with the new image URL."""
     stories_data['stories'][story_index]['coverImageURL'] = image_url
-    stories_data['stories'][story_index]['updatedAt'] = datetime.now().isoformat() + 'Z'
+    stories_data['stories'][story_index]['updatedAt'] = updated_at or datetime.now().isoformat() + 'Z'
+
+
+def load_progress():
+    """
+    Read the uploads recorded in the progress log by an interrupted run.
+    
+    A crash can leave the last record half-written. That record is dropped
+    and cut from the file, so new records start on a clean line. A bad
+    record anywhere else means the log is damaged, and is an error.
+    """
+    if not os.path.exists(PROGRESS_LOG_PATH):
+        return []
+    with open(PROGRESS_LOG_PATH, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    
+    records = []
+    offset = 0
+    for line_number, line in enumerate(lines, 1):
+        try:
+            if line.strip():
+                records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            if line_number < len(lines):
+                raise ValueError(f"{PROGRESS_LOG_PATH}:{line_number}: corrupt progress record") from e
+            print(f"   ⚠️  Dropping incomplete last record in {PROGRESS_LOG_PATH}")
+            os.truncate(PROGRESS_LOG_PATH, offset)
+            return records
+        offset += len(line)
+    
+    # A complete record may still be missing its newline
+    if lines and not lines[-1].endswith(b'\n'):
+        with open(PROGRESS_LOG_PATH, 'ab') as f:
+            f.write(b'\n')
+    return records
+
+
+def append_progress(progress_log, story_index, story, cache_key, local_path):
+    """
+    Durably record one finished upload in the progress log. The image's cache
+    entry is recorded with it, so a crash doesn't lose the run's cache updates.
+    """
+    progress_log.write(json.dumps({
+        "index": story_index,
+        "coverImageURL": story['coverImageURL'],
+        "updatedAt": story['updatedAt'],
+        "cacheKey": cache_key,
+        "localPath": local_path,
+    }) + "\n")
+    progress_log.flush()
+    os.fsync(progress_log.fileno())
+
+
+def record_results(results_q, stories_data, progress_log, cache, story_groups):
+    """
+    Apply finished uploads to stories_data, the progress log and the cache
+    until a None sentinel arrives. Each upload's URL is applied to every story
+    in its group in story_groups. Returns the number of stories updated.
+    """
+    stories = stories_data['stories']
+    success_count = 0
+    while True:
+        item = results_q.get()
+        if item is None:
+            return success_count
+        story_index, image_url = item
+        if not image_url:
+            continue
+        
+        cache_key = prompt_cache_key(stories[story_index]['imagePrompt'])
+        entry = cache.get(cache_key)
+        if entry:
+            entry['url'] = image_url
+        local_path = entry['local'] if entry else None
+        
+        for group_index in story_groups[story_index]:
+            update_stories_json(stories_data, group_index, image_url)
+            append_progress(progress_log, group_index, stories[group_index], cache_key, local_path)
+            success_count += 1
 
 
 def save_stories_json(stories_data):
     """Save updated stories.json."""
-    with open(STORIES_JSON_PATH, 'w', encoding='utf-8') as f:
-        json.dump(stories_data, f, ensure_ascii=False, indent=2)
+    # orjson writes UTF-8 directly and produces the same layout as
+    # json.dump(..., ensure_ascii=False, indent=2)
+    with open(STORIES_JSON_PATH, 'wb') as f:
+        f.write(orjson.dumps(stories_data, option=orjson.OPT_INDENT_2))
     print(f"\n💾 Saved updated {STORIES_JSON_PATH}")
 
 
+async def process_stories(openai_client, stories, indices, upload_q, cache, have_local):
+    """
+    Generate images concurrently, at most MAX_CONCURRENT_GENERATIONS at a time,
+    and put each finished image on upload_q. Returns the number of images generated.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    rate_limiter = RateLimiter(IMAGES_PER_MINUTE)
+    generated_count = 0
+    
+    async def bounded(http_client, position, story_index):
+        nonlocal generated_count
+        async with sem:
+            print(f"\n[{position}/{len(indices)}] ", end="")
+            result = await process_story(
+                openai_client, http_client, rate_limiter, cache, have_local,
+                stories[story_index], story_index, IMAGES_DIR
+            )
+        
+        if result:
+            local_path, remote_path, generated = result
+            generated_count += generated
+            await enqueue_upload(upload_q, local_path, remote_path, story_index)
+    
+    async with create_http_client() as http_client:
+        tasks = [bounded(http_client, i + 1, story_index) for i, story_index in enumerate(indices)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    for story_index, result in zip(indices, results):
+        if isinstance(result, Exception):
+            print(f"❌ Story {story_index}: {result}")
+    
+    return generated_count
+
+
+def stories_to_generate(stories, indices, cache, have_local):
+    """The stories of indices with a prompt but no cached or local image."""
+    return [
+        i for i in indices
+        if stories[i].get('imagePrompt')
+        and not cached_image(cache, prompt_cache_key(stories[i]['imagePrompt']))
+        and story_filename(stories[i], i) not in have_local
+    ]
+
+
+async def generate_stories(run_stories, openai_client, stories, indices, upload_q, cache, have_local):
+    """
+    Finish any batch job left by an interrupted run, drop prompts flagged by
+    moderation, then generate the rest with run_stories. Returns the number
+    of images generated directly and through a resumed batch job.
+    """
+    # The resumed job is already paid for; its images land in the cache, so
+    # the stories it answers are uploaded rather than generated again
+    resumed_count = 0
+    if os.path.exists(BATCH_STATE_PATH):
+        resumed_count = await resume_batch(openai_client, stories, cache)
+    
+    # Only prompts that will reach DALL-E need screening; stories with a
+    # cached or local image are upload-only and must not be dropped
+    to_generate = stories_to_generate(stories, indices, cache, have_local)
+    flagged = await moderate_prompts(openai_client, stories, to_generate)
+    indices = [i for i in indices if i not in flagged]
+    generated_count = await run_stories(openai_client, stories, indices, upload_q, cache, have_local)
+    return generated_count, resumed_count
+
+
+async def process_stories_batch(openai_client, stories, indices, upload_q, cache, have_local):
+    """
+    Generate images through the OpenAI Batch API and put each result on upload_q.
+    
+    All prompts are submitted as a single batch job (half the price of direct
+    calls, no per-request rate limits) and the job is polled until it finishes.
+    Returns the number of images generated.
+    """
+    pending = {}
+    generated_count = 0
+    
+    with open(BATCH_INPUT_PATH, 'w', encoding='utf-8') as f:
+        for story_index in indices:
+            story = stories[story_index]
+            title = story['title']
+            prompt = story.get('imagePrompt', '')
+            
+            if not prompt:
+                print(f"⚠️  Story {story_index}: No image prompt found for '{title}'")
+                continue
+            
+            local_filename = story_filename(story, story_index)
+            local_path = os.path.join(IMAGES_DIR, local_filename)
+            remote_path = remote_path_for(local_filename)
+            cached_path = cached_image(cache, prompt_cache_key(prompt))
+            
+            if cached_path:
+                print(f"♻️  Story {story_index}: Reusing cached image: {cached_path}")
+                await enqueue_upload(upload_q, cached_path, remote_path, story_index)
+                continue
+            
+            if local_filename in have_local:
+                print(f"📁 Story {story_index}: Image already exists locally")
+                await enqueue_upload(upload_q, local_path, remote_path, story_index)
+                continue
+            
+            pending[story['id']] = (story_index, local_path, remote_path)
+            f.write(json.dumps({
+                "custom_id": story['id'],
+                "method": "POST",
+                "url": "/v1/images/generations",
+                "body": {
+                    **IMAGE_GENERATION_PARAMS,
+                    "prompt": build_prompt(prompt),
+                    # Image URLs expire after an hour; batches can take up to 24h
+                    "response_format": "b64_json",
+                },
+            }) + "\n")
+    
+    if not pending:
+        return generated_count
+    
+    print(f"\n📤 Submitting batch of {len(pending)} prompts...")
+    with open(BATCH_INPUT_PATH, 'rb') as f:
+        batch_file = await openai_client.files.create(file=f, purpose="batch")
+    batch = await openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/images/generations",
+        completion_window="24h",
+    )
+    save_batch_state(batch.id, pending)
+    print(f"   Batch ID: {batch.id}")
+    
+    async for story_index, local_path, remote_path in collect_batch(openai_client, batch, pending, stories, cache):
+        generated_count += 1
+        await enqueue_upload(upload_q, local_path, remote_path, story_index)
+    
+    return generated_count
+
+
+def save_batch_state(batch_id, pending):
+    """
+    Durably record a submitted batch job and the stories it answers, so an
+    interrupted run resumes it instead of paying for a second job.
+    """
+    partial_path = BATCH_STATE_PATH + '.part'
+    with open(partial_path, 'w', encoding='utf-8') as f:
+        json.dump({"batchId": batch_id, "pending": pending}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial_path, BATCH_STATE_PATH)
+
+
+async def resume_batch(openai_client, stories, cache):
+    """
+    Finish the batch job recorded by an interrupted run, saving its images
+    to disk and the cache. Returns the number of images saved.
+    """
+    with open(BATCH_STATE_PATH, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    pending = {custom_id: tuple(entry) for custom_id, entry in state['pending'].items()}
+    
+    print(f"\n♻️  Resuming batch {state['batchId']} of {len(pending)} prompts from an interrupted run")
+    batch = await openai_client.batches.retrieve(state['batchId'])
+    return len([item async for item in collect_batch(openai_client, batch, pending, stories, cache)])
+
+
+async def collect_batch(openai_client, batch, pending, stories, cache):
+    """
+    Poll a submitted batch job until it finishes, then save its images and
+    yield (story_index, local_path, remote_path) for each one. The saved
+    batch state is removed once all of the job's results have been read.
+    """
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        print(f"   ⏳ Batch {batch.status}, checking again in {BATCH_POLL_INTERVAL}s...")
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await openai_client.batches.retrieve(batch.id)
+    
+    print(f"   Batch {batch.status}")
+    if batch.status in ("failed", "expired") and batch.errors:
+        for error in batch.errors.data or []:
+            print(f"   ❌ Batch error {error.code}: {error.message}")
+    
+    # Successful requests are written to the output file and failed ones
+    # (e.g. content-policy rejections) to the error file, in the same format
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            async for item in read_batch_results(openai_client, file_id, pending, stories, cache):
+                yield item
+    
+    for story_index, local_path, remote_path in pending.values():
+        print(f"   ❌ Story {story_index}: No result in batch")
+    os.remove(BATCH_STATE_PATH)
+
+
+async def read_batch_results(openai_client, file_id, pending, stories, cache):
+    """
+    Save every image in a batch result file and yield (story_index,
+    local_path, remote_path) for each one, removing each story the file
+    answers from pending.
+    """
+    # Stream the results one line (one image) at a time; reading the whole
+    # file at once would hold every image of the batch in memory
+    async with openai_client.files.with_streaming_response.content(file_id) as output:
+        async for line in output.iter_lines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            story_index, local_path, remote_path = pending.pop(result['custom_id'])
+            
+            response = result.get('response') or {}
+            if response.get('status_code') != 200:
+                print(f"   ❌ Story {story_index}: Error generating image: {result.get('error') or response.get('body')}")
+                continue
+            
+            # Same as download_image: never leave a torn image under its final name
+            partial_path = local_path + '.part'
+            with open(partial_path, 'wb') as f:
+                f.write(base64.b64decode(response['body']['data'][0]['b64_json']))
+            os.replace(partial_path, local_path)
+            print(f"   ✅ Image saved: {local_path}")
+            cache[prompt_cache_key(stories[story_index]['imagePrompt'])] = {"local": local_path, "url": None}
+            yield story_index, local_path, remote_path
+
+
 def main():
     parser = argparse.ArgumentParser(description='Generate story images and upload to Firebase')
     parser.add_argument('--test', action='store_true', help='Test with first story only')
@@ -186,6 +794,8 @@ def main():
     parser.add_argument('--start', type=int, default=0, help='Start index for batch processing')
     parser.add_argument('--count', type=int, default=10, help='Number of stories to process')
     parser.add_argument('--all', action='store_true', help='Process ALL stories (500 images!)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Generate through the OpenAI Batch API (up to 24h, half price)')
     
     args = parser.parse_args()
     
@@ -198,77 +808,144 @@ def main():
     # Initialize clients
     print("🔧 Initializing Firebase...")
     bucket = initialize_firebase()
+    remote_covers = list_remote_covers(bucket)
+    print(f"   {len(remote_covers)} covers already in Firebase Storage")
     
     print("🔧 Initializing OpenAI...")
     openai_client = initialize_openai()
     
     # Load stories
     print(f"📚 Loading stories from {STORIES_JSON_PATH}...")
-    with open(STORIES_JSON_PATH, 'r', encoding='utf-8') as f:
-        stories_data = json.load(f)
+    with open(STORIES_JSON_PATH, 'rb') as f:
+        stories_data = orjson.loads(f.read())
     
     stories = stories_data['stories']
     print(f"   Total stories: {len(stories)}")
     
+    # Story indices per difficulty level, built in one pass
+    level_index = defaultdict(list)
+    for i, story in enumerate(stories):
+        level_index[story['difficultyLevel']].append(i)
+    
     # Create images directory
     os.makedirs(IMAGES_DIR, exist_ok=True)
+    cache = load_cache_index()
+    
+    # Resume an interrupted run: restored stories now have their Firebase URL
+    # and are skipped below
+    progress = load_progress()
+    for record in progress:
+        update_stories_json(stories_data, record['index'], record['coverImageURL'], record['updatedAt'])
+        if record.get('localPath') and os.path.exists(record['localPath']):
+            cache[record['cacheKey']] = {"local": record['localPath'], "url": record['coverImageURL']}
+    if progress:
+        print(f"   ♻️  Restored {len(progress)} uploads from {PROGRESS_LOG_PATH}")
+    
+    # Batch API requests are billed at half price
+    batch_cost_per_image = 0.02
+    cost_per_image = batch_cost_per_image if args.batch else 0.04
     
     # Determine which stories to process
     if args.test:
         indices = [0]
         print(f"\n🧪 TEST MODE: Processing only first story\n")
     elif args.level:
-        indices = [i for i, s in enumerate(stories) if s['difficultyLevel'] == args.level]
+        indices = level_index[args.level]
         print(f"\n🎯 Processing Level {args.level}: {len(indices)} stories\n")
     elif args.all:
         indices = list(range(len(stories)))
-        print(f"\n🚀 PROCESSING ALL {len(stories)} STORIES!")
-        print("   ⚠️  This will take a long time and cost money!")
-        print("   💰 Estimated cost: ~${:.2f} (at $0.04 per image)\n".format(len(stories) * 0.04))
-        confirm = input("   Type 'yes' to continue: ")
-        if confirm != 'yes':
-            print("   Cancelled.")
-            return
+        print(f"\n🚀 PROCESSING ALL {len(stories)} STORIES!\n")
     else:
         end = min(args.start + args.count, len(stories))
         indices = list(range(args.start, end))
         print(f"\n📦 Processing stories {args.start} to {end-1} ({len(indices)} stories)\n")
     
+    # Decide up front what is already done, with one pass over the stories
+    # and one directory listing instead of per-story checks
+    done = {i for i, s in enumerate(stories) if 'firebasestorage' in (s.get('coverImageURL') or '')}
+    # File name -> inode of every local image; scandir gets inodes for free
+    with os.scandir(IMAGES_DIR) as entries:
+        have_local = {entry.name: entry.inode() for entry in entries}
+    skipped_count = sum(1 for i in indices if i in done)
+    indices = [i for i in indices if i not in done]
+    if skipped_count:
+        print(f"⏭️  {skipped_count} stories already have Firebase images, skipping")
+    
+    # Stories with an identical prompt share one generated image: only the
+    # first story of each group is generated and uploaded, and its URL is
+    # written to the whole group
+    by_prompt = defaultdict(list)
+    for i in indices:
+        by_prompt[stories[i].get('imagePrompt') or ''].append(i)
+    story_groups = {group[0]: group for prompt, group in by_prompt.items() if prompt}
+    # Stories without a prompt are reported one by one
+    story_groups.update({i: [i] for i in by_prompt.get('', [])})
+    story_count = len(indices)
+    
+    # Stories whose image is already on disk (upload only, no OpenAI cost) go
+    # first, in inode order so their files are read roughly sequentially;
+    # the stories that need generating follow in story order
+    def local_first(i):
+        inode = have_local.get(story_filename(stories[i], i))
+        return (0, inode) if inode is not None else (1, i)
+    indices = sorted(story_groups, key=local_first)
+    if len(indices) < story_count:
+        print(f"🔗 {story_count - len(indices)} stories share a prompt with another story and reuse its image")
+    print(f"📋 {story_count} stories to process")
+    
+    # Only ask once the stories that will actually reach DALL-E are known
+    if args.all:
+        to_generate = stories_to_generate(stories, indices, cache, have_local)
+        if to_generate:
+            print(f"\n🎨 {len(to_generate)} images to generate")
+            print("   ⚠️  This will take a long time and cost money!")
+            print("   💰 Estimated cost: ~${:.2f} (at ${:.2f} per image)\n".format(
+                len(to_generate) * cost_per_image, cost_per_image))
+            confirm = input("   Type 'yes' to continue: ")
+            if confirm != 'yes':
+                print("   Cancelled.")
+                return
+    
     # Process stories
-    success_count = 0
-    fail_count = 0
+    run_stories = process_stories_batch if args.batch else process_stories
+    # Generators -> upload_q -> uploader threads -> results_q -> writer thread
+    upload_q = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    results_q = queue.Queue()
+    with open(PROGRESS_LOG_PATH, 'a', encoding='utf-8') as progress_log, \
+            ThreadPoolExecutor(max_workers=UPLOAD_WORKERS + 1) as pool:
+        uploaders = [
+            pool.submit(upload_worker, bucket, remote_covers, upload_q, results_q)
+            for _ in range(UPLOAD_WORKERS)
+        ]
+        writer = pool.submit(record_results, results_q, stories_data, progress_log, cache, story_groups)
+        try:
+            generated_count, resumed_count = asyncio.run(generate_stories(
+                run_stories, openai_client, stories, indices, upload_q, cache, have_local
+            ))
+        finally:
+            # Let the uploaders drain the queue, then stop the writer
+            for _ in uploaders:
+                upload_q.put(None)
+            wait(uploaders)
+            results_q.put(None)
+        success_count = writer.result()
     
-    for i, story_index in enumerate(indices):
-        story = stories[story_index]
-        
-        print(f"\n[{i+1}/{len(indices)}] ", end="")
-        
-        image_url = process_story(openai_client, bucket, story, story_index, IMAGES_DIR)
-        
-        if image_url:
-            update_stories_json(stories_data, story_index, image_url)
-            success_count += 1
-            
-            # Save progress every 5 stories
-            if success_count % 5 == 0:
-                save_stories_json(stories_data)
-        else:
-            fail_count += 1
-        
-        # Rate limiting
-        if i < len(indices) - 1:
-            time.sleep(0.5)
+    fail_count = story_count - success_count
     
-    # Final save
+    # Final save; everything in the progress log is now in stories.json
     save_stories_json(stories_data)
+    save_cache_index(cache)
+    os.remove(PROGRESS_LOG_PATH)
     
     # Summary
     print("\n" + "="*60)
     print("📊 SUMMARY")
     print("="*60)
     print(f"✅ Successfully processed: {success_count}")
+    print(f"⏭️  Already on Firebase: {skipped_count}")
     print(f"❌ Failed: {fail_count}")
-    print(f"💰 Estimated cost: ${success_count * 0.04:.2f}")
+    print(f"🎨 Images generated: {generated_count + resumed_count}")
+    print(f"💰 Estimated cost: ${generated_count * cost_per_image + resumed_count * batch_cost_per_image:.2f}")
     print(f"📁 Images saved in: {IMAGES_DIR}/")
     print("="*60)
 